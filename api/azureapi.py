@@ -1,32 +1,190 @@
 """ Azure Retail Prices API
 """
+import functools
+import hashlib
+import os
+import re
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
 
 import enlighten
+import orjson
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import requests
 import requests_cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+# Maximum number of result pages that are downloaded concurrently - across all currencies
+# that are exported at the same time
+MAX_CONCURRENT_PAGES = 32
+
+# Number of pooled keep-alive connections to the API - one per concurrent page download
+POOL_MAXSIZE = MAX_CONCURRENT_PAGES
+
+# Number of days API responses are cached
+CACHE_EXPIRE_DAYS = 1
+
+# Directory of the Parquet cache of transformed price lists
+PRICE_CACHE_DIR = "cache"
+
+# Number of price lists that are kept in memory for reuse. A full price list takes
+# hundreds of MB, so only keep enough for the concurrent currencies of one export
+PRICE_MEMORY_CACHE_SIZE = 2
+
+# Number of rows that are serialized at once when exporting prices to a file
+EXPORT_CHUNK_SIZE = 100_000
+
+# Retry transient API errors (throttling and server errors) with an exponential backoff
+MAX_RETRIES = 5
+RETRY_BACKOFF_FACTOR = 1
+RETRY_STATUS_FORCELIST = (429, 500, 502, 503, 504)
+RETRY_BACKOFF_MAX = 60
+RETRY_BACKOFF_JITTER = 0.5
+
+# Repetitive price item columns that are stored as pandas categoricals to save memory
+CATEGORY_COLUMNS = (
+    "currencyCode",
+    "armRegionName",
+    "location",
+    "serviceName",
+    "serviceFamily",
+    "productName",
+    "skuName",
+    "meterName",
+    "type",
+    "unitOfMeasure",
+    "reservationTerm",
+)
+
+# The API paginates with a numeric $skip offset in the NextPageLink
+_SKIP_PATTERN = re.compile(r"\$skip=(\d+)")
 
-def get_price_data(
-    currency_code: str, results_filter: str = "", max_pages: int = 9999999
-) -> list:
-    """Download price data from the Azure Retail Price API
+
+def _get_page_size(next_page_link: str, page_counter: int) -> int | None:
+    """Derive the number of results per page from the $skip offset of the NextPageLink
 
     Args:
-        currency_code (str): Price currency
-        results_filter (str, optional): Filter results string. Defaults to "". [Examples](https://docs.microsoft.com/en-us/rest/api/cost-management/retail-prices/azure-retail-prices)
-        max_pages (int, optional): Only download max_pages of results - only really useful for debugging.  Defaults to 9999999.
+        next_page_link (str): NextPageLink returned by the API
+        page_counter (int): Number of pages downloaded so far
 
     Returns:
-        [str]: Name of the exported file
-        [list]: Retails prices as a list of dictionaries
+        [int]: Page size or None if the NextPageLink does not use a numeric $skip offset
     """
+    skip_match = _SKIP_PATTERN.search(next_page_link)
+    if skip_match is None:
+        return None
+
+    skip = int(skip_match.group(1))
+    if skip == 0 or skip % page_counter != 0:
+        return None
+
+    return skip // page_counter
+
+
+def _create_session() -> requests.Session:
+    """Create the HTTP session that is shared by all API calls
 
-    # Use requests_cache to temporarily cache results for one day
+    Returns:
+        [requests.Session]: Cached session with a pooled, retrying HTTPS adapter
+    """
+
+    # Use requests_cache to temporarily cache results for CACHE_EXPIRE_DAYS
     # Useful if the script stops unexpectedly and you need to resume
+    # WAL journaling without fsync keeps cache writes from stalling the page downloads -
+    # at worst a crash loses recently cached pages, which are simply downloaded again
     session = requests_cache.CachedSession(
-        "azure_cache", expire_after=timedelta(days=1)
+        backend=requests_cache.SQLiteCache(
+            db_path="azure_cache.sqlite", wal=True, fast_save=True
+        ),
+        expire_after=timedelta(days=CACHE_EXPIRE_DAYS),
+    )
+
+    # Honour the Retry-After header of throttled responses and add jitter to the backoff
+    # so that concurrent page downloads do not retry in lockstep
+    retry_strategy = Retry(
+        total=MAX_RETRIES,
+        backoff_factor=RETRY_BACKOFF_FACTOR,
+        backoff_max=RETRY_BACKOFF_MAX,
+        backoff_jitter=RETRY_BACKOFF_JITTER,
+        status_forcelist=RETRY_STATUS_FORCELIST,
+        allowed_methods=frozenset(["GET"]),
+        respect_retry_after_header=True,
     )
+    session.mount(
+        "https://",
+        HTTPAdapter(
+            pool_connections=1, pool_maxsize=POOL_MAXSIZE, max_retries=retry_strategy
+        ),
+    )
+    session.headers["Connection"] = "keep-alive"
+
+    return session
+
+
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+
+# Limits the page downloads of all concurrent exports, e.g. of several currencies, to MAX_CONCURRENT_PAGES
+_PAGE_SLOTS = threading.BoundedSemaphore(MAX_CONCURRENT_PAGES)
+
+
+def get_session() -> requests.Session:
+    """Return the shared HTTP session - it is created on first use and reused afterwards
+    so that connections to the API are kept alive across pages and currencies
+
+    Returns:
+        [requests.Session]: Shared HTTP session
+    """
+    global _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            _SESSION = _create_session()
+    return _SESSION
+
+
+def _get_page(session: requests.Session, page_link: str) -> dict:
+    """Download and parse a single result page
+
+    Args:
+        session (requests.Session): HTTP session to use
+        page_link (str): URL of the result page
+
+    Returns:
+        [dict]: Parsed JSON result page
+    """
+    with _PAGE_SLOTS:
+        api_request = session.get(page_link)
+
+    # orjson parses the raw response bytes considerably faster than the standard json module
+    return orjson.loads(api_request.content)
+
+
+def _iter_price_pages(
+    currency_code: str,
+    results_filter: str,
+    max_pages: int,
+    session: requests.Session | None,
+):
+    """Download price data from the Azure Retail Price API page by page
+
+    Args:
+        currency_code (str): Price currency
+        results_filter (str): Filter results string
+        max_pages (int): Only download max_pages of results
+        session (requests.Session): HTTP session to use. None uses the shared session.
+
+    Yields:
+        [list]: Retail prices of one result page as a list of dictionaries
+    """
+
+    if session is None:
+        session = get_session()
 
     # Construct the base API url
     api_url = f"https://prices.azure.com/api/retail/prices?api-version=2023-01-01-preview&currencyCode='{currency_code}''"
@@ -35,37 +193,298 @@ def get_price_data(
     if len(results_filter) > 0:
         api_url = f"{api_url}&{results_filter}"
 
-    sku_list = []
-
     next_page_link = api_url
 
     print(f"Starting export for API call: {api_url}")
     page_counter = 0
+    page_size = None
+
+    # Throttle terminal refreshes - the status bar is redrawn at most every half second.
+    # Closing the counter at the end draws the final page count
+    counter = enlighten.Counter(desc="Exported results:", unit="pages", min_delta=0.5)
 
-    counter = enlighten.Counter(desc="Exported results:", unit="pages")
+    # Loop through the result pages. Once the page size is known from the first NextPageLink,
+    # the following pages are requested concurrently. The batch size doubles up to MAX_CONCURRENT_PAGES,
+    # so fewer pages are requested beyond the last page than have already been downloaded
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_PAGES) as executor:
+        while next_page_link is not None and page_counter < max_pages:
+            if page_size is None:
+                page_links = [next_page_link]
+            else:
+                batch_size = min(
+                    page_counter, MAX_CONCURRENT_PAGES, max_pages - page_counter
+                )
+                page_links = [
+                    _SKIP_PATTERN.sub(
+                        f"$skip={(page_counter + i) * page_size}", next_page_link
+                    )
+                    for i in range(batch_size)
+                ]
 
-    # Loop through the result pages
-    while next_page_link is not None and page_counter < max_pages:
-        page_counter = page_counter + 1
+            # Get the next pages - results are returned in page order
+            for result_json in executor.map(
+                lambda page_link: _get_page(session, page_link), page_links
+            ):
+                page_counter = page_counter + 1
 
-        # Get the next page
-        api_request = session.get(next_page_link)
-        result_json = api_request.json()
+                yield result_json["Items"]
 
-        # Convert the JSON results in a list of dictionaries that can be used by pandas
-        for sku_item in result_json["Items"]:
-            sku_list.append(sku_item)
+                next_page_link = result_json["NextPageLink"]
+                counter.update()
 
-        next_page_link = result_json["NextPageLink"]
-        counter.update()
+                # Stop at the last page - any pages requested beyond it are discarded
+                if next_page_link is None:
+                    break
 
+            if page_size is None and next_page_link is not None:
+                page_size = _get_page_size(next_page_link, page_counter)
+
+    counter.close()
     print(f"Completed export of {page_counter} result pages")
 
+
+def get_price_data(
+    currency_code: str,
+    results_filter: str = "",
+    max_pages: int = 9999999,
+    session: requests.Session | None = None,
+) -> list:
+    """Download price data from the Azure Retail Price API
+
+    Args:
+        currency_code (str): Price currency
+        results_filter (str, optional): Filter results string. Defaults to "". [Examples](https://docs.microsoft.com/en-us/rest/api/cost-management/retail-prices/azure-retail-prices)
+        max_pages (int, optional): Only download max_pages of results - only really useful for debugging.  Defaults to 9999999.
+        session (requests.Session, optional): HTTP session to use. Defaults to the shared session.
+
+    Returns:
+        [str]: Name of the exported file
+        [list]: Retails prices as a list of dictionaries
+    """
+
+    sku_list = []
+
+    # Convert the JSON results in a list of dictionaries that can be used by pandas
+    for page_items in _iter_price_pages(
+        currency_code, results_filter, max_pages, session
+    ):
+        sku_list.extend(page_items)
+
     return sku_list
 
 
+def export_price_data(
+    currency_code: str,
+    export_file: str,
+    results_filter: str = "",
+    max_pages: int = 9999999,
+    session: requests.Session | None = None,
+) -> int:
+    """Download price data from the Azure Retail Price API and stream it to a JSON Lines file.
+    Only one result page is held in memory at a time.
+
+    Args:
+        currency_code (str): Price currency
+        export_file (str): Name of the JSON Lines file to write
+        results_filter (str, optional): Filter results string. Defaults to "". [Examples](https://docs.microsoft.com/en-us/rest/api/cost-management/retail-prices/azure-retail-prices)
+        max_pages (int, optional): Only download max_pages of results - only really useful for debugging.  Defaults to 9999999.
+        session (requests.Session, optional): HTTP session to use. Defaults to the shared session.
+
+    Returns:
+        [int]: Number of exported price items
+    """
+
+    item_counter = 0
+
+    with open(export_file, "wb") as sink:
+        for page_items in _iter_price_pages(
+            currency_code, results_filter, max_pages, session
+        ):
+            sink.writelines(orjson.dumps(sku_item) + b"\n" for sku_item in page_items)
+            item_counter = item_counter + len(page_items)
+
+    return item_counter
+
+
+def _to_parquet_compatible(prices_df: pd.DataFrame) -> pd.DataFrame:
+    """Convert object columns with mixed types, e.g. strings and numbers, to strings.
+    Arrow requires a single type per column to write Parquet
+
+    Args:
+        prices_df (pd.DataFrame): Prices to convert
+
+    Returns:
+        [pd.DataFrame]: The prices - a converted copy only if there are mixed-type columns
+    """
+    mixed_columns = []
+    for column, dtype in prices_df.dtypes.items():
+        if dtype != object:
+            continue
+        try:
+            pa.array(prices_df[column], from_pandas=True)
+        except (pa.ArrowTypeError, pa.ArrowInvalid):
+            mixed_columns.append(column)
+
+    if len(mixed_columns) == 0:
+        return prices_df
+
+    return prices_df.astype({column: "string" for column in mixed_columns})
+
+
+def _get_price_cache_file(
+    currency_code: str, results_filter: str, max_pages: int
+) -> str:
+    """Return the Parquet cache file name for a price list
+
+    Args:
+        currency_code (str): Price currency
+        results_filter (str): Filter results string
+        max_pages (int): Maximum number of downloaded result pages
+
+    Returns:
+        [str]: Name of the Parquet cache file
+    """
+    cache_key = hashlib.blake2b(
+        f"{currency_code}|{results_filter}|{max_pages}".encode(), digest_size=16
+    ).hexdigest()
+    return os.path.join(PRICE_CACHE_DIR, f"prices_{currency_code}_{cache_key}.parquet")
+
+
+def _create_prices(
+    currency_code: str,
+    results_filter: str,
+    max_pages: int,
+    session: requests.Session | None,
+    use_cache: bool,
+) -> pd.DataFrame:
+    """Create the price list - loaded from the Parquet cache if use_cache is set and the cache is recent, otherwise downloaded
+
+    Args:
+        currency_code (str): Price currency
+        results_filter (str): Filter results string
+        max_pages (int): Only download max_pages of results
+        session (requests.Session): HTTP session to use. None uses the shared session.
+        use_cache (bool): Load and store the price list in the Parquet cache
+
+    Returns:
+        [pd.DataFrame]: Retails prices as a Pandas data frame
+    """
+
+    cache_file = _get_price_cache_file(currency_code, results_filter, max_pages)
+
+    if use_cache and os.path.exists(cache_file):
+        cache_age = timedelta(seconds=time.time() - os.path.getmtime(cache_file))
+        if cache_age < timedelta(days=CACHE_EXPIRE_DAYS):
+            try:
+                output_df = pd.read_parquet(cache_file, engine="pyarrow")
+            except (OSError, pa.ArrowException) as error:
+                # An unreadable cache file is a cache miss - it is replaced below
+                print(f"Ignoring unreadable cache file {cache_file}: {error}")
+            else:
+                print(f"Loaded {output_df.shape[0]} price items from {cache_file}")
+                return output_df
+
+    input_records = get_price_data(
+        currency_code=currency_code,
+        results_filter=results_filter,
+        max_pages=max_pages,
+        session=session,
+    )
+
+    output_df = pd.DataFrame.from_records(input_records)
+
+    if "savingsPlan" in output_df.columns:
+        # Records with an empty savingsPlan element do not have any prices.
+        # Only filter if there are any, to avoid copying the whole frame
+        empty_savings_plans = output_df["savingsPlan"].map(
+            lambda plans: isinstance(plans, list) and len(plans) == 0
+        )
+        if empty_savings_plans.any():
+            output_df = output_df[~empty_savings_plans]
+
+        # Transform the savingsPlan element: one row per savings plan term
+        output_df = output_df.explode("savingsPlan", ignore_index=True)
+        sp_mask = output_df["savingsPlan"].notna()
+
+        # The column may not hold any savings plan at all, e.g. only None values
+        if sp_mask.any():
+            savings_plans = pd.json_normalize(
+                output_df.loc[sp_mask, "savingsPlan"].tolist()
+            )
+            savings_plans.index = output_df.index[sp_mask]
+
+            output_df.loc[sp_mask, "type"] = "SavingsPlans"
+            output_df.loc[sp_mask, "unitPrice"] = savings_plans["unitPrice"]
+            output_df.loc[sp_mask, "retailPrice"] = savings_plans["retailPrice"]
+            output_df.loc[sp_mask, "reservationTerm"] = savings_plans["term"]
+
+        output_df = output_df.drop(columns="savingsPlan")
+
+    # Categorical columns store each distinct value once instead of one Python string per row
+    for column in CATEGORY_COLUMNS:
+        if column in output_df.columns:
+            output_df[column] = output_df[column].astype("category")
+
+    print(f"Created {output_df.shape[0]} price items")
+
+    if use_cache:
+        # Write to a temporary file and rename it, so that concurrent readers
+        # and interrupted runs never see a partially written cache file.
+        # The cache is best-effort - the downloaded price list is returned even if it cannot be stored
+        temp_file = None
+        try:
+            os.makedirs(PRICE_CACHE_DIR, exist_ok=True)
+            temp_fd, temp_file = tempfile.mkstemp(dir=PRICE_CACHE_DIR, suffix=".tmp")
+            os.close(temp_fd)
+            _to_parquet_compatible(output_df).to_parquet(
+                temp_file, engine="pyarrow", compression="zstd", compression_level=3
+            )
+            os.replace(temp_file, cache_file)
+        except (OSError, pa.ArrowException) as error:
+            print(f"Could not write cache file {cache_file}: {error}")
+        finally:
+            if temp_file is not None and os.path.exists(temp_file):
+                os.remove(temp_file)
+
+    return output_df
+
+
+@functools.lru_cache(maxsize=PRICE_MEMORY_CACHE_SIZE)
+def _get_cached_prices(
+    currency_code: str,
+    results_filter: str,
+    max_pages: int,
+    session: requests.Session | None,
+    cache_period: int,
+) -> pd.DataFrame:
+    """Return the price list, reusing a price list already created in this process with the same arguments
+
+    Args:
+        currency_code (str): Price currency
+        results_filter (str): Filter results string
+        max_pages (int): Only download max_pages of results
+        session (requests.Session): HTTP session to use. None uses the shared session.
+        cache_period (int): Number of the CACHE_EXPIRE_DAYS period the price list was created in - expires it with the Parquet cache
+
+    Returns:
+        [pd.DataFrame]: Retails prices as a Pandas data frame
+    """
+    return _create_prices(
+        currency_code, results_filter, max_pages, session, use_cache=True
+    )
+
+
+def clear_price_cache():
+    """Release the price lists kept in memory by get_prices. The Parquet cache is kept"""
+    _get_cached_prices.cache_clear()
+
+
 def get_prices(
-    currency_code: str, results_filter: str = "", max_pages: int = 9999999
+    currency_code: str,
+    results_filter: str = "",
+    max_pages: int = 9999999,
+    session: requests.Session | None = None,
+    use_cache: bool = True,
 ) -> pd.DataFrame:
     """
     Download prices from the Azure API and creates the price list by transforming the savingsPlan element
@@ -74,35 +493,86 @@ def get_prices(
         currency_code (str): Price currency
         results_filter (str, optional): Filter results string. Defaults to "". [Examples](https://docs.microsoft.com/en-us/rest/api/cost-management/retail-prices/azure-retail-prices)
         max_pages (int, optional): Only download max_pages of results - only really useful for debugging.  Defaults to 9999999.
+        session (requests.Session, optional): HTTP session to use. Defaults to the shared session.
+        use_cache (bool, optional): Reuse one of the last PRICE_MEMORY_CACHE_SIZE price lists created in this process or a price list cached as Parquet within the last CACHE_EXPIRE_DAYS. Use clear_price_cache to release the memory. Defaults to True.
 
     Returns:
         [str]: Name of the exported file
-        [pd.DataFrame]: Retails prices as a Pandas data frame
+        [pd.DataFrame]: Retails prices as a Pandas data frame. With use_cache the data frame is shared by all calls with the same arguments - copy it before modifying it
     """
 
-    input_records = get_price_data(
-        currency_code=currency_code, results_filter=results_filter, max_pages=max_pages
+    if use_cache:
+        cache_period = int(
+            time.time() // timedelta(days=CACHE_EXPIRE_DAYS).total_seconds()
+        )
+        return _get_cached_prices(
+            currency_code, results_filter, max_pages, session, cache_period
+        )
+
+    return _create_prices(
+        currency_code, results_filter, max_pages, session, use_cache=False
     )
 
-    # Transform the savingsPlan element and create a new dictionary
-    output_records = []
-
-    for input_record in input_records:
-        if "savingsPlan" in input_record:
-            # Transform the savingsPlans node
-            savingsPlans = input_record["savingsPlan"]
-            for sp_year in savingsPlans:
-                output_record = input_record.copy()
-                output_record["type"] = "SavingsPlans"
-                output_record["unitPrice"] = sp_year["unitPrice"]
-                output_record["retailPrice"] = sp_year["retailPrice"]
-                output_record["reservationTerm"] = sp_year["term"]
-                del output_record["savingsPlan"]
-                output_records.append(output_record)
-        else:
-            # Just append the original record
-            output_records.append(input_record)
-
-    output_df = pd.DataFrame.from_records(output_records)
-    print(f"Created {output_df.shape[0]} price items")
-    return output_df
+
+def export_csv(export_df: pd.DataFrame, export_file: str):
+    """Export prices to a CSV file using the multi-threaded Arrow CSV writer.
+    Rows are converted and written in record batches of EXPORT_CHUNK_SIZE rows to limit peak memory.
+    Arrow requires a single type per column - columns with mixed types, e.g. strings and numbers, fall back to the slower pandas CSV writer
+
+    Args:
+        export_df (pd.DataFrame): Prices to export
+        export_file (str): Name of the CSV file to write
+    """
+    try:
+        schema = pa.Schema.from_pandas(export_df, preserve_index=False)
+        with pacsv.CSVWriter(export_file, schema) as writer:
+            for start in range(0, export_df.shape[0], EXPORT_CHUNK_SIZE):
+                writer.write_batch(
+                    pa.RecordBatch.from_pandas(
+                        export_df.iloc[start : start + EXPORT_CHUNK_SIZE],
+                        schema=schema,
+                        preserve_index=False,
+                    )
+                )
+    except (pa.ArrowTypeError, pa.ArrowInvalid):
+        # Overwrites a partially written file
+        export_df.to_csv(export_file, index=False)
+
+
+def export_parquet(export_df: pd.DataFrame, export_file: str):
+    """Export prices to a zstd-compressed Parquet file. Categorical columns are stored dictionary-encoded.
+    Columns with mixed types are stored as strings
+
+    Args:
+        export_df (pd.DataFrame): Prices to export
+        export_file (str): Name of the Parquet file to write
+    """
+    _to_parquet_compatible(export_df).to_parquet(
+        export_file,
+        engine="pyarrow",
+        index=False,
+        compression="zstd",
+        row_group_size=100_000,
+        use_dictionary=True,
+    )
+
+
+def export_json(export_df: pd.DataFrame, export_file: str):
+    """Export prices to a JSON file as a list of records using orjson.
+    Records are serialized in chunks of EXPORT_CHUNK_SIZE rows to avoid building the whole document in memory
+
+    Args:
+        export_df (pd.DataFrame): Prices to export
+        export_file (str): Name of the JSON file to write
+    """
+    with open(export_file, "wb") as sink:
+        sink.write(b"[")
+        for start in range(0, export_df.shape[0], EXPORT_CHUNK_SIZE):
+            records = export_df.iloc[start : start + EXPORT_CHUNK_SIZE].to_dict(
+                orient="records"
+            )
+            if start > 0:
+                sink.write(b",")
+            # Strip the brackets of the serialized chunk - they are written once for the whole file
+            sink.write(orjson.dumps(records, option=orjson.OPT_SERIALIZE_NUMPY)[1:-1])
+        sink.write(b"]")
@@ -0,0 +1,13 @@
+""" Shared fixtures for the unit tests
+"""
+
+from api import azureapi
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def clear_price_cache():
+    """Do not share the price lists kept in memory between tests"""
+    azureapi.clear_price_cache()
+    yield
+    azureapi.clear_price_cache()
@@ -1,8 +1,18 @@
 """ Unit tests for azureapi.py
 """
 
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
 from api import azureapi
+import orjson
 import pandas as pd
+import pytest
+import responses
 
 # Currency cod to use
 currency_code = "USD"
@@ -10,14 +20,98 @@ currency_code = "USD"
 # Maximum output pages
 max_pages = 2
 
+# Number of items and page size served by the fake API
+fake_item_count = 2350
+fake_page_size = 100
+
+
+def fake_price_page(
+    page_link: str, use_skip: bool = True, item_count: int = fake_item_count
+) -> dict:
+    """Create a result page of the fake API for a page link
+
+    Args:
+        page_link (str): Requested page link
+        use_skip (bool, optional): Paginate with a numeric $skip offset instead of an opaque token. Defaults to True.
+        item_count (int, optional): Number of items of all pages. Defaults to fake_item_count.
+
+    Returns:
+        [dict]: Result page with Items and NextPageLink
+    """
+    page_match = re.search(r"\$skip(?:token=page|=)(\d+)", page_link)
+    skip = 0 if page_match is None else int(page_match.group(1))
+    if not use_skip:
+        skip = skip * fake_page_size
+
+    items = [
+        {"meterId": str(index), "type": "Consumption", "retailPrice": 1.0}
+        for index in range(skip, min(skip + fake_page_size, item_count))
+    ]
+    # Every third item has a savings plan
+    for sku_item in items[::3]:
+        sku_item["savingsPlan"] = [
+            {"unitPrice": 0.5, "retailPrice": 0.5, "term": "1 Year"}
+        ]
+
+    next_page_link = None
+    next_skip = skip + fake_page_size
+    if next_skip < item_count:
+        base_link = f"https://prices.azure.com:443/api/retail/prices?currencyCode='{currency_code}'"
+        if use_skip:
+            next_page_link = f"{base_link}&$skip={next_skip}"
+        else:
+            next_page_link = f"{base_link}&$skiptoken=page{next_skip // fake_page_size}"
+
+    return {"Items": items, "NextPageLink": next_page_link, "Count": len(items)}
+
+
+class FakePriceSession:
+    """HTTP session that serves the pages of the fake API and records the requested page links"""
+
+    def __init__(self, use_skip: bool = True, item_count: int = fake_item_count):
+        self.use_skip = use_skip
+        self.item_count = item_count
+        self.page_links = []
+        self._lock = threading.Lock()
+
+    def get(self, page_link: str):
+        with self._lock:
+            self.page_links.append(page_link)
+        return SimpleNamespace(
+            content=orjson.dumps(
+                fake_price_page(page_link, self.use_skip, self.item_count)
+            )
+        )
+
+
+@pytest.fixture
+def fake_api(monkeypatch, tmp_path):
+    """Serve the fake API to the real shared session. The session and its response cache are created in tmp_path"""
 
-def test_azureapi_get_price_data():
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(azureapi, "_SESSION", None)
+
+    with responses.RequestsMock(assert_all_requests_are_fired=False) as api_mock:
+        api_mock.add_callback(
+            responses.GET,
+            re.compile(r"https://prices\.azure\.com(:443)?/api/retail/prices"),
+            callback=lambda request: (
+                200,
+                {},
+                orjson.dumps(fake_price_page(request.url)),
+            ),
+        )
+        yield api_mock
+
+
+def test_azureapi_get_price_data(fake_api):
     """Test basic export functionality"""
     sku_list = azureapi.get_price_data(currency_code=currency_code, max_pages=max_pages)
     assert isinstance(sku_list, list)
+    assert len(sku_list) == max_pages * fake_page_size
 
 
-def test_azureapi_savings_plan_get_price_data():
+def test_azureapi_savings_plan_get_price_data(fake_api):
     """Test export with a filter that will include savings plans data"""
 
     filter = "$filter=serviceName eq 'Virtual Machines' and type eq 'Consumption' and armRegionname eq 'westeurope'"
@@ -26,14 +120,372 @@ def test_azureapi_savings_plan_get_price_data():
         currency_code=currency_code, results_filter=filter, max_pages=max_pages
     )
     assert isinstance(sku_list, list)
+    assert any("savingsPlan" in sku_item for sku_item in sku_list)
+    assert "filter" in fake_api.calls[0].request.url
 
 
-def test_azureapi_savings_plan_get_prices():
+def test_azureapi_savings_plan_get_prices(fake_api):
     """Test export with a filter that will include savings plans data"""
 
     filter = "$filter=serviceName eq 'Virtual Machines' and type eq 'Consumption' and armRegionname eq 'westeurope'"
 
     test_df = azureapi.get_prices(
-        currency_code=currency_code, results_filter=filter, max_pages=max_pages
+        currency_code=currency_code,
+        results_filter=filter,
+        max_pages=max_pages,
+        use_cache=False,
     )
     assert isinstance(test_df, pd.DataFrame)
+    assert "SavingsPlans" in test_df["type"].tolist()
+
+
+def test_azureapi_shared_session(fake_api):
+    """Test the retrying, pooled and cached shared session"""
+
+    session = azureapi.get_session()
+    assert azureapi.get_session() is session
+
+    adapter = session.get_adapter("https://prices.azure.com")
+    assert adapter.max_retries.total == azureapi.MAX_RETRIES
+    assert adapter.max_retries.status_forcelist == azureapi.RETRY_STATUS_FORCELIST
+    assert adapter._pool_maxsize == azureapi.POOL_MAXSIZE
+    assert session.headers["Connection"] == "keep-alive"
+
+    # A repeated download is served from the response cache
+    azureapi.get_price_data(currency_code=currency_code, max_pages=max_pages)
+    call_count = len(fake_api.calls)
+    azureapi.get_price_data(currency_code=currency_code, max_pages=max_pages)
+    assert len(fake_api.calls) == call_count
+
+
+@pytest.mark.parametrize("concurrent_pages", [1, 4, 32])
+@pytest.mark.parametrize("page_limit", [1, 2, 5, 24, 33, 34, 9999999])
+@pytest.mark.parametrize("item_count", [150, 250, 950, fake_item_count])
+def test_azureapi_get_price_data_concurrent_pages(
+    monkeypatch, concurrent_pages, page_limit, item_count
+):
+    """Test that concurrently downloaded pages are returned in order and capped at max_pages"""
+
+    monkeypatch.setattr(azureapi, "MAX_CONCURRENT_PAGES", concurrent_pages)
+    session = FakePriceSession(item_count=item_count)
+
+    sku_list = azureapi.get_price_data(
+        currency_code=currency_code, max_pages=page_limit, session=session
+    )
+
+    page_count = -(-item_count // fake_page_size)
+    expected_item_count = min(item_count, page_limit * fake_page_size)
+    assert [sku_item["meterId"] for sku_item in sku_list] == [
+        str(index) for index in range(expected_item_count)
+    ]
+
+    # No more pages than max_pages are requested
+    assert len(session.page_links) <= page_limit
+    if page_limit <= page_count:
+        assert len(session.page_links) == page_limit
+
+    # Fewer pages are requested beyond the last page than were downloaded,
+    # and no further batch is requested once the last page has been returned
+    wasted_page_count = len(session.page_links) - min(page_limit, page_count)
+    assert wasted_page_count < min(page_limit, page_count)
+    assert wasted_page_count < concurrent_pages
+
+
+def test_azureapi_get_price_data_concurrent_currencies(monkeypatch):
+    """Test that concurrent exports of several currencies share the MAX_CONCURRENT_PAGES page downloads"""
+
+    monkeypatch.setattr(azureapi, "_PAGE_SLOTS", threading.BoundedSemaphore(4))
+    active_count = 0
+    max_active_count = 0
+    active_lock = threading.Lock()
+
+    class SlowPriceSession(FakePriceSession):
+        def get(self, page_link: str):
+            nonlocal active_count, max_active_count
+            with active_lock:
+                active_count = active_count + 1
+                max_active_count = max(max_active_count, active_count)
+            time.sleep(0.01)
+            with active_lock:
+                active_count = active_count - 1
+            return super().get(page_link)
+
+    session = SlowPriceSession()
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        sku_lists = list(
+            executor.map(
+                lambda currency: azureapi.get_price_data(currency, session=session),
+                ["USD", "EUR", "GBP"],
+            )
+        )
+
+    assert all(len(sku_list) == fake_item_count for sku_list in sku_lists)
+    assert max_active_count <= 4
+
+
+def test_azureapi_get_price_data_status_bar(monkeypatch):
+    """Test that the status bar is closed after the last page, which draws the final page count"""
+
+    counters = []
+
+    class FakeCounter:
+        def __init__(self, **kwargs):
+            self.count = 0
+            self.closed = False
+            counters.append(self)
+
+        def update(self):
+            self.count = self.count + 1
+
+        def close(self):
+            self.closed = True
+
+    monkeypatch.setattr(azureapi.enlighten, "Counter", FakeCounter)
+    azureapi.get_price_data(currency_code=currency_code, session=FakePriceSession())
+
+    page_count = -(-fake_item_count // fake_page_size)
+    assert [(counter.count, counter.closed) for counter in counters] == [
+        (page_count, True)
+    ]
+
+
+def test_azureapi_get_price_data_without_skip():
+    """Test that page links without a $skip offset are followed one page at a time"""
+
+    session = FakePriceSession(use_skip=False)
+
+    sku_list = azureapi.get_price_data(currency_code=currency_code, session=session)
+
+    assert [sku_item["meterId"] for sku_item in sku_list] == [
+        str(index) for index in range(fake_item_count)
+    ]
+    # Every page is requested exactly once by following the NextPageLink
+    page_count = -(-fake_item_count // fake_page_size)
+    assert len(session.page_links) == page_count
+    assert len(set(session.page_links)) == page_count
+
+
+def test_azureapi_get_prices_savings_plan_transform(monkeypatch):
+    """Test that each savingsPlan term is transformed into its own price item"""
+
+    input_records = [
+        {"meterId": "1", "type": "Consumption", "unitPrice": 1.0, "retailPrice": 1.0},
+        {
+            "meterId": "2",
+            "type": "Consumption",
+            "unitPrice": 2.0,
+            "retailPrice": 2.0,
+            "savingsPlan": [
+                {"unitPrice": 1.5, "retailPrice": 1.5, "term": "1 Year"},
+                {"unitPrice": 1.2, "retailPrice": 1.2, "term": "3 Years"},
+            ],
+        },
+    ]
+    monkeypatch.setattr(azureapi, "get_price_data", lambda **kwargs: input_records)
+
+    test_df = azureapi.get_prices(currency_code=currency_code, use_cache=False)
+
+    assert test_df.shape[0] == 3
+    assert "savingsPlan" not in test_df.columns
+    assert test_df["type"].tolist() == ["Consumption", "SavingsPlans", "SavingsPlans"]
+    assert test_df["retailPrice"].tolist() == pytest.approx([1.0, 1.5, 1.2])
+    assert test_df["reservationTerm"].tolist()[1:] == ["1 Year", "3 Years"]
+
+
+def test_azureapi_get_prices_without_savings_plans(monkeypatch):
+    """Test a savingsPlan element that does not hold any savings plan"""
+
+    input_records = [
+        {"meterId": "1", "type": "Consumption", "unitPrice": 1.0, "retailPrice": 1.0},
+        {
+            "meterId": "2",
+            "type": "Consumption",
+            "unitPrice": 2.0,
+            "retailPrice": 2.0,
+            "savingsPlan": None,
+        },
+    ]
+    monkeypatch.setattr(azureapi, "get_price_data", lambda **kwargs: input_records)
+
+    test_df = azureapi.get_prices(currency_code=currency_code, use_cache=False)
+
+    assert "savingsPlan" not in test_df.columns
+    assert test_df["meterId"].tolist() == ["1", "2"]
+    assert test_df["type"].tolist() == ["Consumption", "Consumption"]
+
+
+def test_azureapi_get_prices_empty_savings_plans(monkeypatch):
+    """Test that records with an empty savingsPlan element are dropped"""
+
+    input_records = [
+        {"meterId": "1", "type": "Consumption", "unitPrice": 1.0, "retailPrice": 1.0},
+        {
+            "meterId": "2",
+            "type": "Consumption",
+            "unitPrice": 2.0,
+            "retailPrice": 2.0,
+            "savingsPlan": [],
+        },
+    ]
+    monkeypatch.setattr(azureapi, "get_price_data", lambda **kwargs: input_records)
+
+    test_df = azureapi.get_prices(currency_code=currency_code, use_cache=False)
+
+    assert "savingsPlan" not in test_df.columns
+    assert test_df["meterId"].tolist() == ["1"]
+    assert test_df["type"].tolist() == ["Consumption"]
+
+
+def test_azureapi_export_price_data(monkeypatch, tmp_path):
+    """Test that price data is streamed to a JSON Lines file"""
+
+    pages = [[{"meterId": "1"}, {"meterId": "2"}], [{"meterId": "3"}]]
+    monkeypatch.setattr(azureapi, "_iter_price_pages", lambda *args: iter(pages))
+
+    export_file = tmp_path / "prices.jsonl"
+    item_count = azureapi.export_price_data(currency_code, str(export_file))
+
+    assert item_count == 3
+    test_df = pd.read_json(export_file, lines=True, dtype=False)
+    assert test_df["meterId"].tolist() == ["1", "2", "3"]
+
+
+def test_azureapi_export_csv_and_json(tmp_path):
+    """Test that prices are exported to CSV and JSON files"""
+
+    export_df = pd.DataFrame(
+        {"meterId": ["1", "2"], "retailPrice": [1.5, None], "type": ["A", "B"]}
+    )
+    export_df["type"] = export_df["type"].astype("category")
+
+    csv_file = tmp_path / "prices.csv"
+    azureapi.export_csv(export_df, str(csv_file))
+    csv_df = pd.read_csv(csv_file, dtype={"meterId": str})
+    assert csv_df["meterId"].tolist() == ["1", "2"]
+    assert csv_df["type"].tolist() == ["A", "B"]
+
+    json_file = tmp_path / "prices.json"
+    azureapi.export_json(export_df, str(json_file))
+    json_df = pd.read_json(json_file, orient="records", dtype=False)
+    assert json_df["retailPrice"].iat[0] == pytest.approx(1.5)
+    assert pd.isna(json_df["retailPrice"].iat[1])
+
+
+def test_azureapi_export_csv_mixed_types(tmp_path):
+    """Test that columns with mixed types are exported to CSV"""
+
+    export_df = pd.DataFrame({"meterId": ["1", "2", "3"], "a": ["x", 1.5, None]})
+
+    csv_file = tmp_path / "prices.csv"
+    azureapi.export_csv(export_df, str(csv_file))
+    csv_df = pd.read_csv(csv_file, dtype=str)
+    assert csv_df["meterId"].tolist() == ["1", "2", "3"]
+    assert csv_df["a"].tolist()[:2] == ["x", "1.5"]
+    assert pd.isna(csv_df["a"].iat[2])
+
+
+def test_azureapi_export_parquet_mixed_types(tmp_path):
+    """Test that columns with mixed types are exported to Parquet as strings"""
+
+    export_df = pd.DataFrame({"meterId": ["1", "2", "3"], "a": ["x", 1.5, None]})
+
+    parquet_file = tmp_path / "prices.parquet"
+    azureapi.export_parquet(export_df, str(parquet_file))
+    parquet_df = pd.read_parquet(parquet_file)
+    assert parquet_df["meterId"].tolist() == ["1", "2", "3"]
+    assert parquet_df["a"].tolist()[:2] == ["x", "1.5"]
+    assert pd.isna(parquet_df["a"].iat[2])
+
+    # The exported data frame is not modified
+    assert export_df["a"].tolist()[:2] == ["x", 1.5]
+
+
+def test_azureapi_get_prices_cache(monkeypatch, tmp_path):
+    """Test that a cached price list is reused instead of downloading it again"""
+
+    input_records = [{"meterId": "1", "type": "Consumption", "retailPrice": 1.0}]
+    monkeypatch.setattr(azureapi, "PRICE_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(azureapi, "get_price_data", lambda **kwargs: input_records)
+
+    cached_df = azureapi.get_prices(currency_code=currency_code)
+
+    # Price lists created in this process are reused as they are
+    monkeypatch.setattr(azureapi, "get_price_data", lambda **kwargs: [])
+    assert azureapi.get_prices(currency_code=currency_code) is cached_df
+
+    # Otherwise the price list is loaded from the Parquet cache
+    azureapi.clear_price_cache()
+    test_df = azureapi.get_prices(currency_code=currency_code)
+
+    pd.testing.assert_frame_equal(test_df, cached_df)
+
+    # Only the last PRICE_MEMORY_CACHE_SIZE price lists are kept in memory
+    for page_limit in range(azureapi.PRICE_MEMORY_CACHE_SIZE):
+        azureapi.get_prices(currency_code=currency_code, max_pages=page_limit)
+    assert azureapi.get_prices(currency_code=currency_code) is not test_df
+
+    # Price lists created in an earlier cache period are not reused
+    test_df = azureapi.get_prices(currency_code=currency_code)
+    cache_time = time.time() + azureapi.CACHE_EXPIRE_DAYS * 24 * 60 * 60
+    monkeypatch.setattr(azureapi.time, "time", lambda: cache_time)
+    assert azureapi.get_prices(currency_code=currency_code) is not test_df
+
+
+def test_azureapi_get_prices_unreadable_cache(monkeypatch, tmp_path):
+    """Test that an unreadable cache file is downloaded again and replaced"""
+
+    input_records = [{"meterId": "1", "type": "Consumption", "retailPrice": 1.0}]
+    monkeypatch.setattr(azureapi, "PRICE_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(azureapi, "get_price_data", lambda **kwargs: input_records)
+
+    cache_file = azureapi._get_price_cache_file(currency_code, "", 9999999)
+    with open(cache_file, "wb") as file:
+        file.write(b"not a parquet file")
+
+    test_df = azureapi._create_prices(
+        currency_code, "", 9999999, session=None, use_cache=True
+    )
+    assert test_df.shape[0] == 1
+
+    # The cache file is replaced atomically without leaving temporary files behind
+    pd.testing.assert_frame_equal(pd.read_parquet(cache_file), test_df)
+    assert os.listdir(tmp_path) == [os.path.basename(cache_file)]
+
+
+def test_azureapi_get_prices_cache_write_error(monkeypatch, tmp_path):
+    """Test that the prices are returned even if the Parquet cache cannot be written"""
+
+    input_records = [
+        {"meterId": "1", "type": "Consumption", "retailPrice": 1.0, "x": "a"},
+        {"meterId": "2", "type": "Consumption", "retailPrice": 1.0, "x": 1.5},
+    ]
+    monkeypatch.setattr(azureapi, "PRICE_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(azureapi, "get_price_data", lambda **kwargs: input_records)
+
+    # A column with mixed types is cached as strings
+    test_df = azureapi.get_prices(currency_code=currency_code)
+    assert test_df["x"].tolist() == ["a", 1.5]
+    azureapi.clear_price_cache()
+    test_df = azureapi.get_prices(currency_code=currency_code)
+    assert test_df["x"].tolist() == ["a", "1.5"]
+
+    # A cache directory that cannot be created
+    cache_dir = tmp_path / "not_a_directory"
+    cache_dir.write_bytes(b"")
+    monkeypatch.setattr(azureapi, "PRICE_CACHE_DIR", str(cache_dir))
+    azureapi.clear_price_cache()
+    test_df = azureapi.get_prices(currency_code=currency_code)
+    assert test_df.shape[0] == 2
+    assert not any(path.suffix == ".tmp" for path in tmp_path.iterdir())
+
+
+def test_azureapi_export_parquet(tmp_path):
+    """Test that prices are exported to a Parquet file"""
+
+    export_df = pd.DataFrame({"meterId": ["1", "2"], "retailPrice": [1.5, None]})
+    export_df["meterId"] = export_df["meterId"].astype("category")
+
+    parquet_file = tmp_path / "prices.parquet"
+    azureapi.export_parquet(export_df, str(parquet_file))
+
+    pd.testing.assert_frame_equal(pd.read_parquet(parquet_file), export_df)
@@ -0,0 +1,177 @@
+""" Unit tests for export.py
+"""
+
+import threading
+
+from api import azureapi
+import export
+import orjson
+import pandas as pd
+import pytest
+
+
+@pytest.fixture
+def fake_prices(monkeypatch, tmp_path):
+    """Replace the API downloads with a small price list and run the exports in tmp_path
+
+    Returns:
+        [list]: Arguments of all get_prices and export_price_data calls
+    """
+
+    monkeypatch.chdir(tmp_path)
+    calls = []
+    calls_lock = threading.Lock()
+
+    def fake_get_prices(
+        currency_code, results_filter="", max_pages=9999999, use_cache=True
+    ):
+        with calls_lock:
+            calls.append(
+                ("get_prices", currency_code, results_filter, max_pages, use_cache)
+            )
+        return pd.DataFrame(
+            {"meterId": ["1", "2"], "currencyCode": currency_code, "retailPrice": 1.0}
+        )
+
+    def fake_export_price_data(currency_code, export_file, results_filter, max_pages):
+        with calls_lock:
+            calls.append(
+                ("export_price_data", currency_code, results_filter, max_pages, None)
+            )
+        with open(export_file, "wb") as file:
+            file.write(orjson.dumps({"meterId": "1"}) + b"\n")
+        return 1
+
+    monkeypatch.setattr(azureapi, "get_prices", fake_get_prices)
+    monkeypatch.setattr(azureapi, "export_price_data", fake_export_price_data)
+    return calls
+
+
+def written_files(tmp_path) -> list:
+    """Names of all files in tmp_path"""
+    return sorted(path.name for path in tmp_path.iterdir())
+
+
+def test_export_defaults(fake_prices, tmp_path):
+    """Test that all USD prices are exported to CSV by default"""
+
+    export.main([])
+
+    assert written_files(tmp_path) == ["prices_USD.csv"]
+    assert fake_prices == [("get_prices", "USD", "", 9999999, True)]
+    assert pd.read_csv(tmp_path / "prices_USD.csv").shape[0] == 2
+
+
+def test_export_arguments(fake_prices, tmp_path):
+    """Test that the command line arguments are passed on to the exports"""
+
+    filter = "$filter=serviceName eq 'Virtual Machines'"
+    export.main(
+        [
+            "--currency",
+            "USD",
+            "EUR",
+            "--filter",
+            filter,
+            "--format",
+            "parquet",
+            "json",
+            "--max-pages",
+            "3",
+            "--file-prefix",
+            "vm",
+            "--no-cache",
+        ]
+    )
+
+    assert written_files(tmp_path) == [
+        "vm_EUR.json",
+        "vm_EUR.parquet",
+        "vm_USD.json",
+        "vm_USD.parquet",
+    ]
+    assert sorted(fake_prices) == [
+        ("get_prices", "EUR", filter, 3, False),
+        ("get_prices", "USD", filter, 3, False),
+    ]
+    assert orjson.loads((tmp_path / "vm_EUR.json").read_bytes())[0] == {
+        "meterId": "1",
+        "currencyCode": "EUR",
+        "retailPrice": 1.0,
+    }
+
+
+def test_export_jsonl(fake_prices, tmp_path):
+    """Test that JSON Lines are streamed from the API and the other formats are exported from the price list"""
+
+    export.main(["--format", "jsonl", "csv"])
+
+    assert written_files(tmp_path) == ["prices_USD.csv", "prices_USD.jsonl"]
+    assert fake_prices == [
+        ("export_price_data", "USD", "", 9999999, None),
+        ("get_prices", "USD", "", 9999999, True),
+    ]
+
+
+def test_export_jsonl_only(fake_prices, tmp_path):
+    """Test that the price list is not created if only JSON Lines are exported"""
+
+    export.main(["--format", "jsonl"])
+
+    assert written_files(tmp_path) == ["prices_USD.jsonl"]
+    assert [call[0] for call in fake_prices] == ["export_price_data"]
+
+
+@pytest.mark.parametrize(
+    "preset, export_files",
+    [
+        ("all_usd", ["prices_USD.csv", "prices_USD.parquet"]),
+        ("all_eur", ["prices_EUR.csv", "prices_EUR.parquet"]),
+        ("all_usd_json", ["prices_all_USD.json"]),
+        ("all_usd_jsonl", ["prices_all_USD.jsonl"]),
+        ("all_usd_limit_10_pages", ["prices_USD.csv", "prices_USD.parquet"]),
+        ("vm_usd", ["prices_USD.json"]),
+        (
+            "hbsv2_usd_eur",
+            [
+                "prices_EUR.csv",
+                "prices_EUR.parquet",
+                "prices_USD.csv",
+                "prices_USD.parquet",
+            ],
+        ),
+    ],
+)
+def test_export_presets(fake_prices, tmp_path, preset, export_files):
+    """Test the files written by each preset"""
+
+    export.main(["--preset", preset])
+
+    assert written_files(tmp_path) == export_files
+    for call in fake_prices:
+        assert call[2] == export.PRESETS[preset].get("results_filter", "")
+        assert call[3] == export.PRESETS[preset].get("max_pages", 9999999)
+
+
+def test_export_presets_no_cache(fake_prices, tmp_path):
+    """Test that several presets can be run at once and --no-cache applies to all of them"""
+
+    export.main(["--preset", "all_usd", "--preset", "vm_usd", "--no-cache"])
+
+    assert written_files(tmp_path) == [
+        "prices_USD.csv",
+        "prices_USD.json",
+        "prices_USD.parquet",
+    ]
+    assert [call[4] for call in fake_prices] == [False, False]
+
+
+def test_export_invalid_arguments(fake_prices, tmp_path):
+    """Test that unknown presets and formats are rejected"""
+
+    with pytest.raises(SystemExit):
+        export.main(["--preset", "unknown"])
+    with pytest.raises(SystemExit):
+        export.main(["--format", "xlsx"])
+
+    assert written_files(tmp_path) == []
@@ -0,0 +1,181 @@
+r""" Export Azure Retail Prices to CSV, Parquet, JSON or JSON Lines files
+
+Examples:
+    python export.py --preset all_usd
+    python export.py --preset vm_usd --preset hbsv2_usd_eur
+    python export.py --currency USD EUR --filter "\$filter=serviceName eq 'Virtual Machines'" --format csv parquet
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import api.azureapi as azureapi
+
+# Supported export file formats
+EXPORT_FORMATS = ("csv", "parquet", "json", "jsonl")
+
+# Predefined exports - several presets can be run in one process and share the API session
+PRESETS = {
+    # All Azure products in USD
+    "all_usd": {"currency_list": ["USD"], "formats": ["csv", "parquet"]},
+    # All Azure products in EUR
+    "all_eur": {"currency_list": ["EUR"], "formats": ["csv", "parquet"]},
+    # All Azure products in USD as JSON
+    "all_usd_json": {
+        "currency_list": ["USD"],
+        "formats": ["json"],
+        "file_prefix": "prices_all",
+    },
+    # All Azure products in USD as JSON Lines - streams the results to disk page by page
+    "all_usd_jsonl": {
+        "currency_list": ["USD"],
+        "formats": ["jsonl"],
+        "file_prefix": "prices_all",
+    },
+    # All Azure products in USD - limited to 10 pages. Useful for developing/debugging
+    "all_usd_limit_10_pages": {
+        "currency_list": ["USD"],
+        "formats": ["csv", "parquet"],
+        "max_pages": 10,
+    },
+    # Virtual Machines in USD as JSON
+    "vm_usd": {
+        "currency_list": ["USD"],
+        "results_filter": "$filter=serviceName eq 'Virtual Machines'",
+        "formats": ["json"],
+    },
+    # Virtual Machines HBSv2 Series in USD and EUR - highlights the usage of API filters
+    "hbsv2_usd_eur": {
+        "currency_list": ["USD", "EUR"],
+        "results_filter": "$filter=serviceName eq 'Virtual Machines' and productName eq 'Virtual Machines HBSv2 Series'",
+        "formats": ["csv", "parquet"],
+    },
+}
+
+
+def export_prices(
+    currency_code: str,
+    results_filter: str = "",
+    max_pages: int = 9999999,
+    formats: tuple = ("csv",),
+    file_prefix: str = "prices",
+    use_cache: bool = True,
+):
+    """Export the prices of one currency to one file per format
+
+    Args:
+        currency_code (str): Price currency
+        results_filter (str, optional): Filter results string. Defaults to "".
+        max_pages (int, optional): Only download max_pages of results. Defaults to 9999999.
+        formats (tuple, optional): Export file formats out of EXPORT_FORMATS. Defaults to ("csv",).
+        file_prefix (str, optional): Export files are named <file_prefix>_<currency_code>.<format>. Defaults to "prices".
+        use_cache (bool, optional): Reuse a cached price list. Defaults to True.
+    """
+
+    # JSON Lines files are streamed from the raw API results
+    if "jsonl" in formats:
+        export_file = f"{file_prefix}_{currency_code}.jsonl"
+        print(f"Exporting prices to {export_file}")
+        item_count = azureapi.export_price_data(
+            currency_code, export_file, results_filter, max_pages
+        )
+        print(f"Exported {item_count} prices to {export_file}")
+
+    # All other formats are exported from the transformed price list
+    dataframe_formats = [
+        export_format for export_format in formats if export_format != "jsonl"
+    ]
+    if len(dataframe_formats) == 0:
+        return
+
+    export_df = azureapi.get_prices(
+        currency_code, results_filter, max_pages, use_cache=use_cache
+    )
+
+    for export_format in dataframe_formats:
+        export_file = f"{file_prefix}_{currency_code}.{export_format}"
+        print(f"Exporting prices to {export_file}")
+        if export_format == "csv":
+            # CSV can just as easily be imported into Excel
+            azureapi.export_csv(export_df, export_file)
+        elif export_format == "parquet":
+            # Parquet is a much smaller file that loads faster into pandas, Power BI or Spark
+            azureapi.export_parquet(export_df, export_file)
+        else:
+            azureapi.export_json(export_df, export_file)
+        print(f"Exported prices to {export_file}")
+
+
+def run_export(currency_list: list, **export_args):
+    """Export the prices of all currencies concurrently over the shared API session.
+    All currencies together download at most azureapi.MAX_CONCURRENT_PAGES pages at a time
+
+    Args:
+        currency_list (list): Price currencies
+        export_args: Further arguments of export_prices
+    """
+    with ThreadPoolExecutor(max_workers=len(currency_list)) as executor:
+        list(
+            executor.map(
+                lambda currency_code: export_prices(currency_code, **export_args),
+                currency_list,
+            )
+        )
+
+
+def main(argv: list | None = None):
+    """Parse the command line and run the requested exports
+
+    Args:
+        argv (list, optional): Command line arguments. Defaults to sys.argv.
+    """
+    parser = argparse.ArgumentParser(description="Export Azure Retail Prices")
+    parser.add_argument(
+        "--preset",
+        action="append",
+        choices=PRESETS.keys(),
+        help="Run a predefined export. Can be repeated - all other arguments are ignored",
+    )
+    parser.add_argument(
+        "--currency", nargs="+", default=["USD"], help="Price currencies"
+    )
+    parser.add_argument("--filter", default="", help="API filter results string")
+    parser.add_argument(
+        "--format",
+        nargs="+",
+        default=["csv"],
+        choices=EXPORT_FORMATS,
+        help="Export file formats",
+    )
+    parser.add_argument(
+        "--max-pages",
+        type=int,
+        default=9999999,
+        help="Only download max pages of results",
+    )
+    parser.add_argument(
+        "--file-prefix", default="prices", help="Prefix of the export file names"
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Always download the prices instead of reusing a cached price list",
+    )
+    args = parser.parse_args(argv)
+
+    if args.preset:
+        for preset in args.preset:
+            print(f"Running preset {preset}")
+            run_export(**PRESETS[preset], use_cache=not args.no_cache)
+    else:
+        run_export(
+            currency_list=args.currency,
+            results_filter=args.filter,
+            max_pages=args.max_pages,
+            formats=args.format,
+            file_prefix=args.file_prefix,
+            use_cache=not args.no_cache,
+        )
+
+
+if __name__ == "__main__":
+    main()